@@ -1,9 +1,14 @@
+import copy
 import sys
+from abc import ABC, abstractmethod
+from bisect import bisect_right
+from functools import cached_property
 from statistics import mean
 
-from music21 import dynamics, note, pitch
-from music21.interval import Direction, Interval
+from music21 import note, pitch
+from music21.interval import Interval
 
+from passage import get_segments
 from util import *
 
 
@@ -22,284 +27,690 @@ class RegisterPreference():
 class RegisterBoundaries:
     MID_HIGH = pitch.Pitch('E5')
     LOW_MID = pitch.Pitch('E4')
+    MID_HIGH_PS = MID_HIGH.ps
+    LOW_MID_PS = LOW_MID.ps
 
-# Gives a difficulty score for a given note's pitch register
+# Gives a difficulty score for a pitch's register given the instrument's written range
 # Returns 10.0 if above playable range, and -10.0 if below playable range
-def note_pitch_register_difficulty(note, registerDifficulty=Fatigue):
-    instrument = note.getInstrument()
-    if note.pitch > instrument.highest_written():
+# Compares pitches like music21's > and >= (a pitch only reaches a boundary with the same pitch space value
+# if it is also spelled the same), but only works out the pitch space value of the pitch once
+def pitch_register_band(p, lowest, highest, registerDifficulty=Fatigue):
+    ps = p.ps
+    if ps > highest.ps:
         return 10.0
-    elif note.pitch >= RegisterBoundaries.MID_HIGH:
+    elif ps > RegisterBoundaries.MID_HIGH_PS or p == RegisterBoundaries.MID_HIGH:
         return registerDifficulty.HIGH
-    elif note.pitch >= RegisterBoundaries.LOW_MID:
+    elif ps > RegisterBoundaries.LOW_MID_PS or p == RegisterBoundaries.LOW_MID:
         return registerDifficulty.MID
-    elif note.pitch >= instrument.lowest_written():
+    elif ps > lowest.ps or p == lowest:
         return registerDifficulty.LOW
     else:
         return -10.0
 
+# Gives a difficulty score for a given note's pitch register
+# Returns 10.0 if above playable range, and -10.0 if below playable range
+def note_pitch_register_difficulty(note, registerDifficulty=Fatigue):
+    instrument = note.getInstrument()
+    return pitch_register_band(note.pitch, instrument.lowest_written(), instrument.highest_written(), registerDifficulty)
+
+# Copies of a list of pitches transposed by whole octaves, each made at most once
+# Setting the octave spells each pitch the same as transposing it by perfect octaves
+class OctaveTranspositions:
+    def __init__(self, pitches):
+        self.transposed = {0: pitches}
+
+    def __getitem__(self, octaves):
+        if octaves not in self.transposed:
+            transposed = []
+            for p in self.transposed[0]:
+                p_transposed = copy.deepcopy(p)
+                p_transposed.octave = p.implicitOctave + octaves
+                transposed.append(p_transposed)
+            self.transposed[octaves] = transposed
+        return self.transposed[octaves]
+
+# Tests if a list of pitches contains any out-of-range pitches
+# Returns 0 if all pitches are in range
+# Returns 10.0 if there is a pitch above the maximum
+# Returns -10.0 if there is a pitch below the minimum
+def pitches_out_of_range(pitches, lowest, highest):
+    for p in pitches:
+        diff = pitch_register_band(p, lowest, highest)
+        if abs(diff) == 10.0:
+            return diff
+    return 0
+
+# Calculates the average register difficulty of a list of pitches
+def pitches_register_difficulty(pitches, lowest, highest):
+    total_difficulty = 0
+    for p in pitches:
+        total_difficulty += pitch_register_band(p, lowest, highest, RegisterPreference)
+    return total_difficulty / len(pitches)
+
+# Finds the octave transposition (up or down an octave) that brings a passage back into the
+# instrument's playable range if it contains any out-of-range pitches
+# Returns (octaves, still out of range after transposing)
+def playable_octave_transposition(transpositions, lowest, highest):
+    octaves = 0
+    out_of_range = pitches_out_of_range(transpositions[0], lowest, highest)
+    if out_of_range:
+        # Too high -> down an octave, too low -> up an octave
+        octaves = -1 if out_of_range > 0 else 1
+    return (octaves, bool(pitches_out_of_range(transpositions[octaves], lowest, highest)))
+
+# Finds the octave transposition of a passage with the easiest register by trying octaves
+# up and down from the starting transposition until it goes out of range
+# Returns (octaves, out of range after transposing)
+def optimal_octave_transposition(transpositions, lowest, highest, start=0):
+    optimal = start
+    min_difficulty = pitches_register_difficulty(transpositions[start], lowest, highest)
+    for step in (1, -1):
+        current = start
+        while not pitches_out_of_range(transpositions[current], lowest, highest):
+            diff = pitches_register_difficulty(transpositions[current], lowest, highest)
+            if diff < min_difficulty:
+                min_difficulty = diff
+                optimal = current
+            current += step
+    return (optimal, bool(pitches_out_of_range(transpositions[optimal], lowest, highest)))
+
+# Finds the octave transposition that ensure_passage_in_playable_range() followed by
+# optimise_passage_register() gives a passage with the given pitches
+# Returns (octaves, transposed pitches, out of range after ensuring range, out of range after optimising)
+def passage_octave_transposition(pitches, lowest, highest):
+    transpositions = OctaveTranspositions(pitches)
+    (start, out_of_range_first) = playable_octave_transposition(transpositions, lowest, highest)
+    (octaves, out_of_range_second) = optimal_octave_transposition(transpositions, lowest, highest, start)
+    return (octaves, transpositions[octaves], out_of_range_first, out_of_range_second)
+
+def transpose_passage_octaves(passage, octaves):
+    for _ in range(abs(octaves)):
+        passage.transpose(Interval('P8' if octaves > 0 else 'P-8'))
+
+# Returns the passage's notes' pitches and its instrument's written range
+def passage_pitches_and_range(passage):
+    pitches = [n.pitch for n in passage.get_notes()]
+    return (pitches, passage.instrument.lowest_written(), passage.instrument.highest_written())
+
 # Tests if a passage contains any out-of-range notes
 # Returns 0 if all notes are in range
 # Returns 10.0 if there is a note above the maximum
 # Returns -10.0 if there is a note below the minimum
 def passage_out_of_range(passage):
-    for note in passage.get_notes():
-        diff = note_pitch_register_difficulty(note)
-        if abs(diff) == 10.0:
-            return diff
-    return 0
+    return pitches_out_of_range(*passage_pitches_and_range(passage))
 
 # Transposes a passage up or down an octave if it contains any notes outside of the instrument's playable range
 def ensure_passage_in_playable_range(passage):
-    out_of_range = passage_out_of_range(passage)
-    if out_of_range:
-        if out_of_range > 0:
-            # Too high
-            passage.transpose(Interval('P-8'))
-        else:
-            # Too low
-            passage.transpose(Interval('P8'))
-    return bool(passage_out_of_range(passage))
+    (pitches, lowest, highest) = passage_pitches_and_range(passage)
+    (octaves, out_of_range) = playable_octave_transposition(OctaveTranspositions(pitches), lowest, highest)
+    transpose_passage_octaves(passage, octaves)
+    return out_of_range
 
 # Calculates the average register difficulty of all the notes in a passage
 def passage_pitch_register_difficulty(passage):
-    notes = passage.get_notes()
-    total_difficulty = 0
-    for note in notes:
-        total_difficulty += note_pitch_register_difficulty(note, RegisterPreference)
-    return total_difficulty / len(notes)
+    return pitches_register_difficulty(*passage_pitches_and_range(passage))
 
 # Transposes a passage up and down octaves to find its easiest register
 def optimise_passage_register(passage):
-    optimal_octave_transposition = 0
-    current_octave_transposition = 0
-    min_difficulty = passage_pitch_register_difficulty(passage)
-
-    # Transpose up 8ves until it's out of range
-    while not passage_out_of_range(passage):
-        diff = passage_pitch_register_difficulty(passage)
-        if diff < min_difficulty:
-            min_difficulty = diff
-            optimal_octave_transposition = current_octave_transposition
-        passage.transpose(Interval('P8'))
-        current_octave_transposition += 1
-
-    # Reset to 0 transposition
-    while current_octave_transposition > 0:
-        passage.transpose(Interval('P-8'))
-        current_octave_transposition -= 1
-
-    # Transpose down 8ves until it's out of range
-    while not passage_out_of_range(passage):
-        diff = passage_pitch_register_difficulty(passage)
-        if diff < min_difficulty:
-            min_difficulty = diff
-            optimal_octave_transposition = current_octave_transposition
-        passage.transpose(Interval('P-8'))
-        current_octave_transposition -= 1
-
-    # Transpose back up 8ves until we find the optimal again
-    while current_octave_transposition < optimal_octave_transposition:
-        passage.transpose(Interval('P8'))
-        current_octave_transposition += 1
-    return bool(passage_out_of_range(passage))
+    (pitches, lowest, highest) = passage_pitches_and_range(passage)
+    (octaves, out_of_range) = optimal_octave_transposition(OctaveTranspositions(pitches), lowest, highest)
+    transpose_passage_octaves(passage, octaves)
+    return out_of_range
+
+# Moves each passage of a written-pitch part into its easiest playable register
+# The same as calling ensure_passage_in_playable_range() and optimise_passage_register() on each
+# passage, but each passage is only transposed once
+# Returns True if any passage can't be played within the instrument's range
+def optimise_part_register(part):
+    instrument = part.getInstrument()
+    lowest = instrument.lowest_written()
+    highest = instrument.highest_written()
+    for passage in get_segments(part):
+        pitches = [n.pitch for n in passage.get_notes()]
+        (octaves, _, out_of_range_first, out_of_range_second) = passage_octave_transposition(pitches, lowest, highest)
+        transpose_passage_octaves(passage, octaves)
+        if out_of_range_first and out_of_range_second:
+            return True
+    return False
 
 
 ############## DIFFICULTY METRICS ##############
 
+# Each metric is a reducer that consumes the notes and rests of a part one at a time.
+# All registered reducers share a single pass over the part (see part_metrics()),
+# so a new metric only needs a MetricReducer subclass decorated with @register_metric.
+
+FINGERING_DIFF = {
+    0:   {0: 0.0, 1: 1.0, 2: 1.0, 3: 1.9, 12: 1.5, 13: 3.0, 23: 3.0, 123: 3.5},
+    1:   {0: 1.0, 1: 0.0, 2: 2.0, 3: 3.0, 12: 2.0, 13: 1.5, 23: 7.5, 123: 6.0},
+    2:   {0: 1.0, 1: 1.5, 2: 0.0, 3: 5.3, 12: 3.0, 13: 9.5, 23: 6.0, 123: 9.0},
+    3:   {0: 2.5, 1: 4.0, 2: 4.5, 3: 0.0, 12: 7.0, 13: 4.0, 23: 4.0, 123: 5.5},
+    12:  {0: 1.5, 1: 1.5, 2: 2.3, 3: 7.5, 12: 0.0, 13: 6.0, 23: 6.0, 123: 5.0},
+    13:  {0: 3.5, 1: 4.0, 2: 9.5, 3: 1.5, 12: 5.5, 13: 0.0, 23: 6.0, 123: 4.0},
+    23:  {0: 2.5, 1: 6.0, 2: 5.5, 3: 4.0, 12: 5.0, 13: 5.5, 23: 0.0, 123: 3.8},
+    123: {0: 3.0, 1: 4.0, 2: 8.5, 3: 3.5, 12: 6.0, 13: 5.0, 23: 5.0, 123: 0.0}
+}
+
+# The values of a note or rest that don't depend on its pitch, computed at most once
+# These can be shared between events for the same note played at different pitches
+class ElementInfo:
+    def __init__(self, element):
+        self.element = element
+        self.is_note = isinstance(element, note.Note)
+
+    @cached_property
+    def seconds(self):
+        return self.element.seconds
+
+    # Value of the dynamic marking in effect (e.g. 'mf'), or None if there isn't one
+    @cached_property
+    def dynamic(self):
+        dynamic = self.element.volume.getDynamicContext()
+        return dynamic.value if dynamic else None
+
+    # Whether the note ends a phrase mark (slur)
+    @cached_property
+    def phrase_end(self):
+        slurs = self.element.getSpannerSites('Slur')
+        return bool(slurs) and slurs[0].isLast(self.element)
+
+# A note or rest in a part at a given written pitch, with values used by several metrics computed at most once
+class NoteEvent:
+    def __init__(self, info, index, pitch, instrument, lowest, highest):
+        self.info = info
+        self.element = info.element
+        # Position of the element in the part's notes and rests
+        self.index = index
+        self.is_note = info.is_note
+        # None for rests
+        self.pitch = pitch
+        self.instrument = instrument
+        self.lowest = lowest
+        self.highest = highest
+
+    @property
+    def seconds(self):
+        return self.info.seconds
+
+    @property
+    def dynamic(self):
+        return self.info.dynamic
+
+    @property
+    def phrase_end(self):
+        return self.info.phrase_end
+
+    # Register difficulty (using Fatigue scores) of a note
+    @cached_property
+    def register(self):
+        return pitch_register_band(self.pitch, self.lowest, self.highest)
+
+class MetricReducer(ABC):
+    # Names of the values returned by result()
+    names = ()
+
+    def __init__(self):
+        # Metric name -> list of (event index, amount added to the metric's running total by that event)
+        self.contributions = {}
+
+    # Records the amount an event added to a metric's running total, for metric_breakdown()
+    def contribute(self, name, event, amount):
+        self.contributions.setdefault(name, []).append((event.index, amount))
+
+    @abstractmethod
+    def step(self, event):
+        pass
+
+    # Returns a dictionary of metric name -> value
+    @abstractmethod
+    def result(self):
+        pass
+
+    # Returns a dictionary of metric name -> what the running total is divided by to give its value
+    # None if the value doesn't depend on the running total
+    # Metrics left out of the dictionary can't be split between passages and measures, so metric_breakdown()
+    # leaves them at 0 and prints a warning
+    def denominators(self):
+        return {}
+
+    # Returns a dictionary of any non-numeric output, such as chosen fingerings
+    def details(self):
+        return {}
+
+# Reducer for metrics that average a cost over each transition between consecutive sounding notes
+class TransitionReducer(MetricReducer):
+    def __init__(self):
+        super().__init__()
+        self.prev = None
+        self.num_of_notes = 0
+        self.total_difficulty = 0
+
+    @abstractmethod
+    def transition(self, prev, curr):
+        pass
+
+    def step(self, event):
+        if event.is_note:
+            self.num_of_notes += 1
+            # If the previous element was a rest then don't count the transition
+            if self.prev is not None and self.prev.is_note:
+                difficulty = self.transition(self.prev, event)
+                self.total_difficulty += difficulty
+                self.contribute(self.names[0], event, difficulty)
+        self.prev = event
+
+    def result(self):
+        if self.num_of_notes <= 1:
+            return {self.names[0]: 0.0}
+        # Avg difficulty = total difficulty / number of sounding-note transitions
+        return {self.names[0]: self.total_difficulty / (self.num_of_notes - 1)}
+
+    def denominators(self):
+        return {self.names[0]: self.num_of_notes - 1 if self.num_of_notes > 1 else None}
+
+METRIC_REDUCERS = []
+
+# Class decorator to include a reducer in the shared metric pass
+def register_metric(reducer):
+    METRIC_REDUCERS.append(reducer)
+    return reducer
+
+# Runs each reducer over a sequence of NoteEvents in a single pass
+# Returns the reducers, ready for their results
+def run_reducers(events, reducers=None):
+    if reducers is None:
+        reducers = METRIC_REDUCERS
+    reducers = [reducer() for reducer in reducers]
+    for event in events:
+        for reducer in reducers:
+            reducer.step(event)
+    return reducers
+
+# Runs each reducer over the notes and rests of a part in a single pass
+# Returns a dictionary of metric name -> value
+# If a details dictionary is given, it is updated with each reducer's non-numeric output
+# and with the breakdown of each metric by passage and measure (see metric_breakdown())
+def part_metrics(part, reducers=None, details=None):
+    instrument = part.getInstrument()
+    lowest = instrument.lowest_written()
+    highest = instrument.highest_written()
+    flat_part = part.flatten()
+    offsets = []
+    # Events are created while iterating, since element durations in seconds depend on the active site
+    def events():
+        for element in flat_part.notesAndRests:
+            info = ElementInfo(element)
+            yield NoteEvent(info, len(offsets), element.pitch if info.is_note else None, instrument, lowest, highest)
+            offsets.append(flat_part.elementOffset(element))
+    reducers = run_reducers(events(), reducers)
+    metrics = {}
+    for reducer in reducers:
+        metrics.update(reducer.result())
+        if details is not None:
+            details.update(reducer.details())
+    if details is not None:
+        details['breakdown'] = metric_breakdown(part, offsets, reducers)
+    return metrics
+
+# Returns the offsets of the first and last notes of each passage of a part (see get_segments())
+# as (list of start offsets, list of end offsets)
+def passage_offsets(part):
+    starts = []
+    ends = []
+    for passage in get_segments(part):
+        start_note = passage.start_note or passage.end_note
+        end_note = passage.end_note or passage.start_note
+        starts.append(start_note.getOffsetInHierarchy(part))
+        ends.append(end_note.getOffsetInHierarchy(part))
+    return (starts, ends)
+
+# (reducer class, metric name) pairs already warned about, so each is only reported once
+MISSING_DENOMINATORS = set()
+
+def warn_missing_denominator(reducer, name):
+    if (reducer, name) not in MISSING_DENOMINATORS:
+        MISSING_DENOMINATORS.add((reducer, name))
+        print('Warning:', reducer.__name__, 'gives no denominator for', name + ', so it is left out of the breakdown', file=sys.stderr)
+
+# Splits each metric of a part into the contributions of each passage (see get_segments()) and each measure
+# Contributions are in the same units as the part's metrics, so the passages (or measures) sum to the part's values
+# Notes and rests outside of any passage are counted under passage None
+# Metrics without a denominator from their reducer are left at 0 in every entry, with a warning
+# Returns {'passages': [entry, ...], 'measures': [entry, ...]} where each entry is a dictionary of metric name -> contribution
+def metric_breakdown(part, offsets, reducers):
+    names = [name for reducer in reducers for name in reducer.names]
+    measures = list(part.getElementsByClass('Measure'))
+    measure_offsets = [m.offset for m in measures]
+
+    def measure_number(offset):
+        i = bisect_right(measure_offsets, offset) - 1
+        return measures[max(i, 0)].number if measures else None
+
+    (starts, ends) = passage_offsets(part)
+
+    def passage_index(offset):
+        i = bisect_right(starts, offset) - 1
+        if i >= 0 and offset <= ends[i]:
+            return i
+        return None
 
-# Measure of the proportion of notes that are in high registers
-# Ranges from 4.25 to 9.5
-def pitch_register_difficulty(part):
-    total_register_difficulty = 0
-    notes = part.flatten().notes
-    for note in notes:
-        total_register_difficulty += note_pitch_register_difficulty(note)
-    # Avg register difficulty = total register difficulty / number of notes
-    return total_register_difficulty / len(notes)
+    def new_entry(**fields):
+        fields.update({name: 0 for name in names})
+        return fields
+
+    passage_entries = {}
+    for i in range(len(starts)):
+        passage_entries[i] = new_entry(passage=i, start_measure=measure_number(starts[i]), end_measure=measure_number(ends[i]))
+    measure_entries = {}
+    event_passages = []
+    event_measures = []
+    for offset in offsets:
+        i = passage_index(offset)
+        if i not in passage_entries:
+            passage_entries[i] = new_entry(passage=None, start_measure=None, end_measure=None)
+        event_passages.append(passage_entries[i])
+        number = measure_number(offset)
+        if number not in measure_entries:
+            measure_entries[number] = new_entry(measure=number)
+        event_measures.append(measure_entries[number])
+
+    for reducer in reducers:
+        denominators = reducer.denominators()
+        for name in reducer.names:
+            if name not in denominators:
+                warn_missing_denominator(type(reducer), name)
+                continue
+            denominator = denominators[name]
+            if not denominator:
+                continue
+            for (index, amount) in reducer.contributions.get(name, []):
+                event_passages[index][name] += amount / denominator
+                event_measures[index][name] += amount / denominator
+
+    return {
+        'passages': list(passage_entries.values()),
+        'measures': list(measure_entries.values())
+    }
 
-# Measure of how difficult the change in fingering is for each note transition
+
+# Difficulty of each interval transition
+# Ranges from 1 to 12
+@register_metric
+class IntervalReducer(TransitionReducer):
+    names = ('interval',)
+
+    LOW_ASC =   [1.0,1.5,1.5,1.5,2.5,2.0,3.5,3.0,4.0,4.0,5.5,5.5,7.0]
+    LOW_DESC =  [1.0,1.5,1.5,2.0,2.0,2.5,5.0,6.0,6.5,6.5,8.5,8.5,11.5]
+    MID_ASC =   [1.0,1.0,1.3,2.0,2.0,4.5,5.5,5.0,7.5,8.0,9.0,9.5,12.0]
+    MID_DESC =  [1.0,3.5,3.5,4.5,4.5,6.5,7.5,7.0,9.0,9.0,10.0,10.5,12.0]
+    HIGH_ASC =  [5.8,5.8,6.3,7.8,8.0,8.3,9.5,9.5,11.0,11.0,11.8,11.0,2.5]
+    HIGH_DESC = [5.8,6.5,7.0,8.0,8.3,8.5,10.0,9.0,10.0,10.0,12.0,12.0,12.0]
+
+    def transition(self, prev, curr):
+        semitones = curr.pitch.midi - prev.pitch.midi
+        ascending = semitones > 0
+        # Reduce intervals greater than an octave to be within an octave
+        interval_semitones = abs(semitones)
+        interval_semitones = interval_semitones if interval_semitones <= 12 else interval_semitones % 12
+
+        if curr.register >= Fatigue.HIGH:
+            table = self.HIGH_ASC if ascending else self.HIGH_DESC
+        elif curr.register >= Fatigue.MID:
+            table = self.MID_ASC if ascending else self.MID_DESC
+        else:
+            table = self.LOW_ASC if ascending else self.LOW_DESC
+        return table[interval_semitones]
+
+# Measure of how tired your lips get
 # Ranges from 0 to 9.5
-def fingering_difficulty(part):
-    FINGERING_DIFF = {
-        0:   {0: 0.0, 1: 1.0, 2: 1.0, 3: 1.9, 12: 1.5, 13: 3.0, 23: 3.0, 123: 3.5},
-        1:   {0: 1.0, 1: 0.0, 2: 2.0, 3: 3.0, 12: 2.0, 13: 1.5, 23: 7.5, 123: 6.0},
-        2:   {0: 1.0, 1: 1.5, 2: 0.0, 3: 5.3, 12: 3.0, 13: 9.5, 23: 6.0, 123: 9.0},
-        3:   {0: 2.5, 1: 4.0, 2: 4.5, 3: 0.0, 12: 7.0, 13: 4.0, 23: 4.0, 123: 5.5},
-        12:  {0: 1.5, 1: 1.5, 2: 2.3, 3: 7.5, 12: 0.0, 13: 6.0, 23: 6.0, 123: 5.0},
-        13:  {0: 3.5, 1: 4.0, 2: 9.5, 3: 1.5, 12: 5.5, 13: 0.0, 23: 6.0, 123: 4.0},
-        23:  {0: 2.5, 1: 6.0, 2: 5.5, 3: 4.0, 12: 5.0, 13: 5.5, 23: 0.0, 123: 3.8},
-        123: {0: 3.0, 1: 4.0, 2: 8.5, 3: 3.5, 12: 6.0, 13: 5.0, 23: 5.0, 123: 0.0}
-    }
+@register_metric
+class EmbouchureReducer(MetricReducer):
+    names = ('embouchure',)
+
+    def __init__(self):
+        super().__init__()
+        self.total_duration = 0
+        self.total_embouchure_endurance_difficulty = 0
+
+    def step(self, event):
+        duration = event.seconds
+        self.total_duration += duration
+        previous_total = self.total_embouchure_endurance_difficulty
+        if event.is_note:
+            if abs(event.register) != 10.0:
+                self.total_embouchure_endurance_difficulty += duration * event.register
+        else:
+            # Rests recover at 3 units per second
+            self.total_embouchure_endurance_difficulty = max(self.total_embouchure_endurance_difficulty - (duration * 3.0), 0)
+        self.contribute('embouchure', event, self.total_embouchure_endurance_difficulty - previous_total)
+
+    def result(self):
+        # Avg embouchure endurance difficulty = total embouchure endurance difficulty / duration of piece
+        return {'embouchure': self.total_embouchure_endurance_difficulty / self.total_duration}
 
-    notes = part.flatten().notesAndRests
-    num_of_notes = len(notes)
-    num_of_rests = 0 if not isinstance(notes[0], note.Rest) else 1
-    total_fingering_difficulty = 0
-
-    for i in range(1, num_of_notes):
-        prev_note = notes[i-1]
-        curr_note = notes[i]
-        # If this is a rest then don't count the transition from the previous note
-        if isinstance(curr_note, note.Rest) or isinstance(prev_note, note.Rest):
-            if isinstance(curr_note, note.Rest):
-                num_of_rests += 1
-            continue
-        instrument = curr_note.getInstrument()
-        prev_fingering = instrument.fingering[prev_note.pitch.midi]
-        curr_fingering = instrument.fingering[curr_note.pitch.midi]
-        total_fingering_difficulty += FINGERING_DIFF[prev_fingering][curr_fingering]
-
-    num_of_notes -= num_of_rests
-    if num_of_notes <= 1:
-        return 0.0
-    # Avg fingering difficulty = total fingering difficulty / number of sounding-note transitions
-    return total_fingering_difficulty / (num_of_notes - 1)
+    def denominators(self):
+        return {'embouchure': self.total_duration}
 
 # Models depletion of lung air contents over the course of the piece
-# Returns (average breathing difficulty, num. of out of breath instances)
+# Gives the average breathing difficulty and num. of out of breath instances
 # Ranges from 0 to 100
-def breathing_difficulty(part):
+@register_metric
+class BreathingReducer(MetricReducer):
+    names = ('breathing', 'out_of_breath')
+
     LOW = {'pp': 35.5, 'p': 29.1, 'mp': 23.5, 'mf': 18.4, 'f': 14.0, 'ff': 10.5}
     MID = {'pp': 40.0, 'p': 35.8, 'mp': 31.0, 'mf': 26.2, 'f': 21.0, 'ff': 14.5}
     HIGH = {'pp': 11.0, 'p': 13.4, 'mp': 15.0, 'mf': 13.6, 'f': 10.5, 'ff': 9.0}
 
-    total_duration = 0
-    out_of_breath_instances = 0
-    lung_contents = 1.0
-    contents_sum = 0
-    notes = part.flatten().notesAndRests
-
-    for element in notes:
-        duration = element.seconds
-        if isinstance(element, note.Note):
-            dynamic = element.volume.getDynamicContext()
-            if not dynamic or dynamic.value not in LOW:
+    def __init__(self):
+        super().__init__()
+        self.num_of_elements = 0
+        self.out_of_breath_instances = 0
+        self.lung_contents = 1.0
+        self.contents_sum = 0
+
+    def step(self, event):
+        duration = event.seconds
+        if event.is_note:
+            dynamic_value = event.dynamic
+            if dynamic_value not in self.LOW:
                 # Default to mf if no or unknown dynamics are present
-                dynamic = dynamics.Dynamic('mf')
+                dynamic_value = 'mf'
 
-            note_diff = note_pitch_register_difficulty(element)
-            if note_diff >= Fatigue.HIGH:
-                air_depleted = duration / HIGH[dynamic.value]
-            elif note_diff >= Fatigue.MID:
-                air_depleted = duration / MID[dynamic.value]
+            if event.register >= Fatigue.HIGH:
+                air_depleted = duration / self.HIGH[dynamic_value]
+            elif event.register >= Fatigue.MID:
+                air_depleted = duration / self.MID[dynamic_value]
             else:
-                air_depleted = duration / LOW[dynamic.value]
+                air_depleted = duration / self.LOW[dynamic_value]
 
-            lung_contents = max(lung_contents - air_depleted, 0)
+            self.lung_contents = max(self.lung_contents - air_depleted, 0)
 
             # If at the end of a phrase, allow a quick breath without out-of-breath penalty
-            slurs = element.getSpannerSites('Slur')
-            if slurs and slurs[0].isLast(element):
-                lung_contents = max(lung_contents, 0.25)
+            if event.phrase_end:
+                self.lung_contents = max(self.lung_contents, 0.25)
 
-            if lung_contents == 0:
+            if self.lung_contents == 0:
                 # Out-of-breath instance
-                out_of_breath_instances += 1
-                lung_contents = 2/3
+                self.out_of_breath_instances += 1
+                self.contribute('out_of_breath', event, 1)
+                self.lung_contents = 2/3
         else:
             # Rests over 0.25s allow for breaths to be taken
             if duration > 0.25:
                 air_replenished = duration - 0.25
-                lung_contents = min(lung_contents + air_replenished, 1)
-        contents_sum += lung_contents
-        total_duration += duration
-    
-    avg_lung_contents = contents_sum / len(notes)
-    avg_breathing_difficulty = 100 - (avg_lung_contents * 100)
-    return (avg_breathing_difficulty, out_of_breath_instances)
+                self.lung_contents = min(self.lung_contents + air_replenished, 1)
+        self.contents_sum += self.lung_contents
+        self.num_of_elements += 1
+        self.contribute('breathing', event, 100 - (self.lung_contents * 100))
 
-# Measure of how tired your lips get
+    def result(self):
+        avg_lung_contents = self.contents_sum / self.num_of_elements
+        return {
+            'breathing': 100 - (avg_lung_contents * 100),
+            'out_of_breath': self.out_of_breath_instances
+        }
+
+    def denominators(self):
+        return {'breathing': self.num_of_elements, 'out_of_breath': 1}
+
+# Measure of how difficult the change in fingering is for each note transition
+# Where a pitch has alternate fingerings, the path of fingerings with the minimum total
+# difficulty is chosen with a Viterbi search over each phrase between rests
 # Ranges from 0 to 9.5
-def embouchure_endurance_difficulty(part):
-    total_duration = 0
-    total_embouchure_endurance_difficulty = 0
-
-    for element in part.flatten().notesAndRests:
-        duration = element.seconds
-        total_duration += duration
-        if isinstance(element, note.Note):
-            note_diff = note_pitch_register_difficulty(element)
-            if abs(note_diff) != 10.0:
-                total_embouchure_endurance_difficulty += duration * note_diff
-        else:
-            # Rests recover at 3 units per second
-            total_embouchure_endurance_difficulty = max(total_embouchure_endurance_difficulty - (duration * 3.0), 0)
+@register_metric
+class FingeringReducer(MetricReducer):
+    names = ('fingering',)
+
+    def __init__(self):
+        super().__init__()
+        self.num_of_notes = 0
+        self.total_fingering_difficulty = 0
+        # Min. total difficulty so far ending on each fingering of the previous note
+        self.costs = None
+        # For each note in the current phrase: (NoteEvent, {fingering: fingering of previous note})
+        self.backpointers = []
+        self.path = []
+
+    def step(self, event):
+        if not event.is_note:
+            # Don't count the transition from the previous note over a rest
+            self.end_phrase()
+            return
+        self.num_of_notes += 1
+        options = event.instrument.fingerings(event.pitch.midi)
+        if self.costs is None:
+            self.costs = {f: self.total_fingering_difficulty for f in options}
+            self.backpointers.append((event, {f: None for f in options}))
+            return
+        costs = {}
+        backpointer = {}
+        for f in options:
+            prev_f = min(self.costs, key=lambda p: self.costs[p] + FINGERING_DIFF[p][f])
+            costs[f] = self.costs[prev_f] + FINGERING_DIFF[prev_f][f]
+            backpointer[f] = prev_f
+        self.costs = costs
+        self.backpointers.append((event, backpointer))
+
+    def end_phrase(self):
+        if self.costs is None:
+            return
+        f = min(self.costs, key=self.costs.get)
+        self.total_fingering_difficulty = self.costs[f]
+        phrase = []
+        for (event, backpointer) in reversed(self.backpointers):
+            phrase.append((event, f))
+            f = backpointer[f]
+        phrase.reverse()
+        for i in range(1, len(phrase)):
+            self.contribute('fingering', phrase[i][0], FINGERING_DIFF[phrase[i-1][1]][phrase[i][1]])
+        self.path += [(event.pitch.nameWithOctave, f) for (event, f) in phrase]
+        self.costs = None
+        self.backpointers = []
+
+    def result(self):
+        self.end_phrase()
+        if self.num_of_notes <= 1:
+            return {'fingering': 0.0}
+        # Avg fingering difficulty = total fingering difficulty / number of sounding-note transitions
+        return {'fingering': self.total_fingering_difficulty / (self.num_of_notes - 1)}
+
+    def denominators(self):
+        return {'fingering': self.num_of_notes - 1 if self.num_of_notes > 1 else None}
+
+    # The chosen fingering for each note as a list of (note name, valve combination)
+    def details(self):
+        self.end_phrase()
+        return {'fingering_path': self.path}
 
-    # Avg embouchure endurance difficulty = total embouchure endurance difficulty / duration of piece
-    return total_embouchure_endurance_difficulty / total_duration
+# Measure of the proportion of notes that are in high registers
+# Ranges from 4.25 to 9.5
+@register_metric
+class RegisterReducer(MetricReducer):
+    names = ('register',)
 
+    def __init__(self):
+        super().__init__()
+        self.num_of_notes = 0
+        self.total_register_difficulty = 0
 
-# Difficulty of each interval transition
-# Ranges from 1 to 12
-def melodic_interval_difficulty(part):
-    LOW_ASC =   [1.0,1.5,1.5,1.5,2.5,2.0,3.5,3.0,4.0,4.0,5.5,5.5,7.0]
-    LOW_DESC =  [1.0,1.5,1.5,2.0,2.0,2.5,5.0,6.0,6.5,6.5,8.5,8.5,11.5]
-    MID_ASC =   [1.0,1.0,1.3,2.0,2.0,4.5,5.5,5.0,7.5,8.0,9.0,9.5,12.0]
-    MID_DESC =  [1.0,3.5,3.5,4.5,4.5,6.5,7.5,7.0,9.0,9.0,10.0,10.5,12.0]
-    HIGH_ASC =  [5.8,5.8,6.3,7.8,8.0,8.3,9.5,9.5,11.0,11.0,11.8,11.0,2.5]
-    HIGH_DESC = [5.8,6.5,7.0,8.0,8.3,8.5,10.0,9.0,10.0,10.0,12.0,12.0,12.0]
+    def step(self, event):
+        if event.is_note:
+            self.num_of_notes += 1
+            self.total_register_difficulty += event.register
+            self.contribute('register', event, event.register)
 
-    notes = part.flatten().notesAndRests
-    num_of_notes = len(notes)
-    num_of_rests = 0 if not isinstance(notes[0], note.Rest) else 1
-    total_interval_difficulty = 0
+    def result(self):
+        # Avg register difficulty = total register difficulty / number of notes
+        return {'register': self.total_register_difficulty / self.num_of_notes}
 
-    for i in range(1, num_of_notes):
-        prev_note = notes[i-1]
-        curr_note = notes[i]
+    def denominators(self):
+        return {'register': self.num_of_notes}
 
-        # If this is a rest then don't count the interval from the previous note
-        if isinstance(curr_note, note.Rest) or isinstance(prev_note, note.Rest):
-            if isinstance(curr_note, note.Rest):
-                num_of_rests += 1
-            continue
 
-        interval = Interval(prev_note, curr_note)
-        # Reduce intervals greater than an octave to be within an octave
-        interval_semitones = abs(interval.semitones)
-        interval_semitones = interval_semitones if interval_semitones <= 12 else interval_semitones % 12
+def pitch_register_difficulty(part):
+    return part_metrics(part, [RegisterReducer])['register']
 
-        if note_pitch_register_difficulty(curr_note) >= Fatigue.HIGH:
-            if interval.direction == Direction.ASCENDING:
-                total_interval_difficulty += HIGH_ASC[interval_semitones]
-            else:
-                total_interval_difficulty += HIGH_DESC[interval_semitones]
-        elif note_pitch_register_difficulty(curr_note) >= Fatigue.MID:
-            if interval.direction == Direction.ASCENDING:
-                total_interval_difficulty += MID_ASC[interval_semitones]
-            else:
-                total_interval_difficulty += MID_DESC[interval_semitones]
-        else:
-            if interval.direction == Direction.ASCENDING:
-                total_interval_difficulty += LOW_ASC[interval_semitones]
-            else:
-                total_interval_difficulty += LOW_DESC[interval_semitones]
+def fingering_difficulty(part):
+    return part_metrics(part, [FingeringReducer])['fingering']
+
+# Returns the minimum-difficulty fingering for each note as a list of (note name, valve combination)
+def optimal_fingerings(part):
+    details = {}
+    part_metrics(part, [FingeringReducer], details)
+    return details['fingering_path']
 
-    num_of_notes -= num_of_rests
-    if num_of_notes <= 1:
-        return 0.0
-    # Avg interval difficulty = total interval difficulty / number of intervallic transitions
-    return total_interval_difficulty / (num_of_notes - 1)
+# Returns (average breathing difficulty, num. of out of breath instances)
+def breathing_difficulty(part):
+    metrics = part_metrics(part, [BreathingReducer])
+    return (metrics['breathing'], metrics['out_of_breath'])
 
+def embouchure_endurance_difficulty(part):
+    return part_metrics(part, [EmbouchureReducer])['embouchure']
 
-# Calculate and return each difficulty metric combined for all parts
+def melodic_interval_difficulty(part):
+    return part_metrics(part, [IntervalReducer])['interval']
+
+
+# Increase whenever a change to the arrangement or the metrics changes the difficulty values,
+# so that stored results (see manifest.py) are recalculated
+SCORING_VERSION = 1
+
+DIFFICULTY_NAMES = ('interval', 'embouchure', 'breathing', 'out_of_breath', 'fingering', 'register')
+
+# Calculate each registered metric combined for all parts, in one pass per part
 # Contribution of each part to the scores is determined by part_weights
-def part_difficulties(score, part_weights=[0.5,0.5]):
+# Returns a dictionary of metric name -> weighted value
+# If a details list is given, the non-numeric output for each part is appended to it
+def weighted_part_metrics(score, part_weights=[0.5,0.5], details=None):
     if len(part_weights) != len(score.parts) or sum(part_weights) != 1.0:
         print('Error: Invalid part weights entered', file=sys.stderr)
         return None
-    interval = embouchure = breathing = out_of_breath = fingering = register = 0
+    metrics = {}
     for i in range(len(score.parts)):
-        part = score.parts[i]
-        interval += part_weights[i] * melodic_interval_difficulty(part)
-        embouchure += part_weights[i] * embouchure_endurance_difficulty(part)
-        (breathing_, out_of_breath_) = breathing_difficulty(part)
-        breathing += part_weights[i] * breathing_
-        out_of_breath += part_weights[i] * out_of_breath_
-        fingering += part_weights[i] * fingering_difficulty(part)
-        register += part_weights[i] * pitch_register_difficulty(part)
-    return (interval, embouchure, breathing, out_of_breath, fingering, register)
+        part_details = {}
+        if details is not None:
+            details.append(part_details)
+        for name, value in part_metrics(score.parts[i], details=part_details).items():
+            metrics[name] = metrics.get(name, 0) + part_weights[i] * value
+        if details is not None:
+            add_total_contributions(part_details['breakdown'], part_weights[i])
+    return metrics
+
+# Adds the contribution of each passage and measure of a part to the overall difficulty
+# (excluding sharps and key distance) to its metric breakdown
+def add_total_contributions(breakdown, part_weight):
+    for entry in breakdown['passages'] + breakdown['measures']:
+        difficulties = normalise_difficulties(tuple(part_weight * entry[name] for name in DIFFICULTY_NAMES))
+        entry['total'] = combine_difficulties(difficulties, 0, 0)[-1]
+
+# Calculate and return each difficulty metric combined for all parts
+# Contribution of each part to the scores is determined by part_weights
+def part_difficulties(score, part_weights=[0.5,0.5], details=None):
+    metrics = weighted_part_metrics(score, part_weights, details)
+    if metrics is None:
+        return None
+    return tuple(metrics[name] for name in DIFFICULTY_NAMES)
 
 def normalise_difficulties(difficulties):
     (interval, embouchure, breathing, out_of_breath, fingering, register) = difficulties
@@ -312,13 +723,20 @@ def normalise_difficulties(difficulties):
         register / 0.95
     )
 
-# Calculate overall difficulty score as weighted sum of each difficulty metric
-def overall_difficulty(score, original_key, sharps, printDifficulties=True):
-    distance_to_original_key = key_distance(original_key.sharps, sharps)
-    sharps_per_instrument = get_sharps_per_instrument(sharps)
-    avg_sharps_per_instrument = mean([abs(v) for v in sharps_per_instrument.values()])
+# Average number of sharps or flats written for each instrument for a given concert pitch key
+def avg_sharps_per_instrument(sharps, instruments):
+    sharps_per_instrument = get_sharps_per_instrument(sharps, instruments)
+    return mean([abs(v) for v in sharps_per_instrument.values()])
 
-    difficulties = normalise_difficulties(part_difficulties(score))
+# The part of the overall difficulty that only depends on the key, which can be found without arranging
+# Used to decide which keys to try first
+def key_difficulty(original_key, sharps, instruments):
+    return 0.1 * avg_sharps_per_instrument(sharps, instruments) \
+        + 0.05 * key_distance(original_key.sharps, sharps)
+
+# Calculate overall difficulty score as weighted sum of each normalised difficulty metric
+# Returns the metrics followed by the overall difficulty, as returned by overall_difficulty()
+def combine_difficulties(difficulties, avg_sharps_per_instrument, distance_to_original_key):
     (interval, embouchure, breathing, out_of_breath, fingering, register) = difficulties
 
     total_difficulty = 0.25 * interval \
@@ -330,17 +748,6 @@ def overall_difficulty(score, original_key, sharps, printDifficulties=True):
         + 0.1 * avg_sharps_per_instrument \
         + 0.05 * distance_to_original_key
 
-    if printDifficulties:
-        print('Interval:         ', interval)
-        print('Embouchure:       ', embouchure)
-        print('Breathing:        ', breathing)
-        print('Out-of-breath:    ', out_of_breath)
-        print('Fingering:        ', fingering)
-        print('Register:         ', register)
-        print('Avg sharps/flats: ', avg_sharps_per_instrument)
-        print('Key distance:     ', distance_to_original_key)
-        print('\nTotal difficulty: ', total_difficulty)
-
     return (
         interval,
         embouchure,
@@ -352,3 +759,37 @@ def overall_difficulty(score, original_key, sharps, printDifficulties=True):
         distance_to_original_key,
         total_difficulty
     )
+
+def print_difficulties(difficulties):
+    (interval,
+    embouchure,
+    breathing,
+    out_of_breath,
+    fingering,
+    register,
+    avg_sharps_per_instrument,
+    distance_to_original_key,
+    total_difficulty) = difficulties
+    print('Interval:         ', interval)
+    print('Embouchure:       ', embouchure)
+    print('Breathing:        ', breathing)
+    print('Out-of-breath:    ', out_of_breath)
+    print('Fingering:        ', fingering)
+    print('Register:         ', register)
+    print('Avg sharps/flats: ', avg_sharps_per_instrument)
+    print('Key distance:     ', distance_to_original_key)
+    print('\nTotal difficulty: ', total_difficulty)
+
+# Calculate overall difficulty score as weighted sum of each difficulty metric
+# If a details list is given, the non-numeric output of the metrics for each part is appended to it
+def overall_difficulty(score, original_key, sharps, printDifficulties=True, details=None):
+    distance_to_original_key = key_distance(original_key.sharps, sharps)
+    avg_sharps = avg_sharps_per_instrument(sharps, [part.getInstrument() for part in score.parts])
+
+    difficulties = normalise_difficulties(part_difficulties(score, details=details))
+    difficulties = combine_difficulties(difficulties, avg_sharps, distance_to_original_key)
+
+    if printDifficulties:
+        print_difficulties(difficulties)
+
+    return difficulties
@@ -1,56 +1,87 @@
 import argparse
+import copy
+import csv
+import time
 from pathlib import Path
 
 import load
 from difficulty import *
+from manifest import Manifest
 from passage import *
+from search import search_instruments
 from util import *
 
 EXAMPLES_DIR = Path('examples')
-TEST_DIR = EXAMPLES_DIR / 'test'
 OUT_DIR = Path('out')
+DATA_PATH = OUT_DIR / 'data.csv'
+MANIFEST_PATH = OUT_DIR / 'manifest.json'
+
+DATA_HEADER = ['Title@Sharps','Interval','Embouchure','Breathing','Out-of-breath','Fingering','Register','Avg sharps','Key distance','Overall']
+BREAKDOWN_HEADER = ['Part','Level','Index','Start measure','End measure','Interval','Embouchure','Breathing','Out-of-breath','Fingering','Register','Overall']
+# Stored results in the manifest are discarded if they were generated with a different version
+MANIFEST_VERSION = [SCORING_VERSION, DATA_HEADER, BREAKDOWN_HEADER]
 
 class BrassDuet:
 
-    def __init__(self, path: Path):
+    # If a loaded score is given it is copied instead of loading the file again
+    def __init__(self, path: Path, instruments=(TenorHorn, BaritoneHorn), score=None):
         self.in_path = path
         self.out_path = OUT_DIR / path.name
-        self.original_score = load.load_xml(self.in_path)
+        self.instruments = instruments
+        if score is None:
+            self.original_score = load.load_xml(self.in_path, instruments=instruments)
+        else:
+            self.original_score = copy.deepcopy(score)
+            load.set_instruments(self.original_score, instruments)
         self.arrangements = []
+        # Keys that weren't arranged because the time budget ran out
+        self.skipped_keys = []
 
-    def arrange(self, printDifficulties=True):
+    # If a time budget (in seconds) is given, the keys with the lowest key_difficulty() are tried first
+    # and a key isn't started if it would likely run over the budget (taking as long as the last key did),
+    # unless no arrangement has been found yet
+    # The budget only covers this method, not loading the score or saving and exporting the arrangement
+    def arrange(self, printDifficulties=True, keys=KEYS, time_budget=None):
+        start_time = time.perf_counter()
         original_key = getKey(self.original_score)
-        for sharps in range(-5,2):
+        if time_budget is not None:
+            instruments = [instrument() for instrument in self.instruments]
+            keys = sorted(keys, key=lambda sharps: key_difficulty(original_key, sharps, instruments))
+        # Time taken to try the last key
+        last_key_time = 0
+        for sharps in keys:
+            key_start_time = time.perf_counter()
+            if time_budget is not None and self.arrangements and key_start_time - start_time + last_key_time > time_budget:
+                self.skipped_keys.append(sharps)
+                continue
+
             transposed_score = transpose_to_key_sig(self.original_score, sharps).toWrittenPitch()
 
             if printDifficulties:
                 print('\n=========================')
                 print('Key: ', sharps, 'sharps\n')
 
-            out_of_playable_range = False        
-            for part in transposed_score.parts:
-                passages = get_segments(part)
-                for passage in passages:
-                    out_of_range_first = ensure_passage_in_playable_range(passage)
-                    out_of_range_second = optimise_passage_register(passage)
-                    if out_of_range_first and out_of_range_second:
-                        out_of_playable_range = True
-                        break
+            out_of_playable_range = any(optimise_part_register(part) for part in transposed_score.parts)
             if out_of_playable_range:
                 if printDifficulties:
                     print('Error: Contains notes out of range. Add more phrase marks or reduce range',file=sys.stderr)
+                last_key_time = time.perf_counter() - key_start_time
                 continue
             
             score_for_analysis = transposed_score.stripTies()
-            difficulties = overall_difficulty(score_for_analysis, original_key, sharps, printDifficulties=printDifficulties)
-            arrangement = Arrangement(transposed_score, sharps, difficulties)
+            details = []
+            difficulties = overall_difficulty(score_for_analysis, original_key, sharps, printDifficulties=printDifficulties, details=details)
+            arrangement = Arrangement(transposed_score, sharps, difficulties, details)
             self.arrangements.append(arrangement)
+            last_key_time = time.perf_counter() - key_start_time
 
         if printDifficulties:
             best = self.get_arrangement()
             print('\n=========================')
             print('Best arrangement: ', best.sharps, 'sharps')
             print('Total difficulty: ', best.total_difficulty, '\n')
+            if self.skipped_keys:
+                print('Time budget ran out. Keys not tried:', ', '.join(str(sharps) + ' sharps' for sharps in self.skipped_keys), '\n')
 
     def get_arrangement(self):
         if not self.arrangements:
@@ -71,6 +102,15 @@ class BrassDuet:
             a.total_difficulty
         )
 
+    def print_fingerings(self):
+        if not self.arrangements:
+            print('Error: No arrangement generated. Call arrange() or get_arrangement() first', file=sys.stderr)
+            return
+        a = self.get_arrangement()
+        for (part, fingerings) in zip(a.score.parts, a.fingerings):
+            print('\n' + part.getInstrument().instrumentName + ':')
+            print(' '.join(name + '(' + str(f) + ')' for (name, f) in fingerings))
+
     def save(self):
         if not self.arrangements:
             print('Error: No arrangement generated. Call arrange() or get_arrangement() first', file=sys.stderr)
@@ -90,9 +130,16 @@ class BrassDuet:
 
 # Class to store an arrangement and its difficulty metrics
 class Arrangement:
-    def __init__(self, score, sharps, difficulties):
+    def __init__(self, score, sharps, difficulties, details=None):
         self.score = score
         self.sharps = sharps
+        # Non-numeric output of the difficulty metrics for each part
+        self.details = details if details is not None else []
+        # Chosen (note name, valve combination) sequence for each part
+        self.fingerings = [d.get('fingering_path', []) for d in self.details]
+        # Contribution of each passage and measure to the difficulty metrics for each part
+        # (see difficulty.metric_breakdown())
+        self.breakdown = [d.get('breakdown') for d in self.details]
         (self.interval,
         self.embouchure,
         self.breathing,
@@ -103,31 +150,135 @@ class Arrangement:
         self.distance_to_original_key,
         self.total_difficulty) = difficulties
 
+    # Returns the breakdown as rows of strings in the format of BREAKDOWN_HEADER
+    # Passages outside of any phrase (rests) have an empty index
+    def breakdown_rows(self):
+        rows = []
+        for (part, breakdown) in zip(self.score.parts, self.breakdown):
+            name = part.getInstrument().instrumentName
+            for entry in breakdown['passages']:
+                rows.append([name, 'passage', entry['passage'], entry['start_measure'], entry['end_measure']] + self._breakdown_values(entry))
+            for entry in breakdown['measures']:
+                rows.append([name, 'measure', entry['measure'], entry['measure'], entry['measure']] + self._breakdown_values(entry))
+        return [['' if v is None else str(v) for v in row] for row in rows]
+
+    @staticmethod
+    def _breakdown_values(entry):
+        return [entry[name] for name in DIFFICULTY_NAMES] + [entry['total']]
+
+    def export_breakdown(self, path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(BREAKDOWN_HEADER)
+            writer.writerows(self.breakdown_rows())
+        print('Breakdown saved to', path)
+
+# Returns the data rows (as strings) for every arrangement of a piece
+def arrangement_rows(duet):
+    title = duet.original_score.metadata.title
+    rows = []
+    for a in duet.arrangements:
+        rows.append([str(v) for v in (
+            title+'@'+str(a.sharps),
+            a.interval,
+            a.embouchure,
+            a.breathing,
+            a.out_of_breath,
+            a.fingering,
+            a.register,
+            a.avg_sharps_per_instrument,
+            a.distance_to_original_key,
+            a.total_difficulty
+        )])
+    return rows
+
+# Returns the breakdown rows (as strings) for every arrangement of a piece, each starting with its title and key
+def arrangement_breakdown_rows(duet):
+    title = duet.original_score.metadata.title
+    rows = []
+    for a in duet.arrangements:
+        rows += [[title+'@'+str(a.sharps)] + row for row in a.breakdown_rows()]
+    return rows
+
+def save_breakdown(path, rows):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(DATA_HEADER[:1] + BREAKDOWN_HEADER)
+        writer.writerows(rows)
+    print('Breakdown saved to', path, file=sys.stderr)
+
 # Generate and print metrics for a list of paths to .mxl files
-def generate_data(pieces):
-    print('Title@Sharps,Interval,Embouchure,Breathing,Out-of-breath,Fingering,Register,Avg sharps,Key distance,Overall')
+# If a breakdown path is given, the breakdown of every arrangement is also saved there as a .csv file
+def generate_data(pieces, breakdown_path=None):
+    print(','.join(DATA_HEADER))
+    breakdown_rows = []
     for piece in pieces:
         duet = BrassDuet(piece)
         duet.arrange(printDifficulties=False)
-        title = duet.original_score.metadata.title
-        for a in duet.arrangements:
-            print(
-                title+'@'+str(a.sharps),
-                a.interval,
-                a.embouchure,
-                a.breathing,
-                a.out_of_breath,
-                a.fingering,
-                a.register,
-                a.avg_sharps_per_instrument,
-                a.distance_to_original_key,
-                a.total_difficulty,
-                sep=','
-            )
+        for row in arrangement_rows(duet):
+            print(*row, sep=',')
+        if breakdown_path is not None:
+            breakdown_rows += arrangement_breakdown_rows(duet)
+    if breakdown_path is not None:
+        save_breakdown(breakdown_path, breakdown_rows)
+
+# Generate metrics for a list of paths to .mxl files and store them in a .csv file
+# Only new or changed files are arranged; rows for unchanged files are kept from the manifest
+# and rows for files that no longer exist are removed
+# Files that can't be arranged are recorded with no rows (dropping any previous rows) and only tried again once they change
+# If a breakdown path is given, breakdown rows are also stored in the manifest and saved there as a .csv file
+# in the same way as the data. Files arranged without a breakdown are arranged again the first time one is asked for
+def generate_data_incremental(pieces, data_path=DATA_PATH, manifest_path=MANIFEST_PATH, breakdown_path=None):
+    manifest = Manifest(manifest_path, MANIFEST_VERSION)
+    removed = manifest.prune(pieces)
+    for key in removed:
+        print('Removed', key, file=sys.stderr)
+    breakdown = breakdown_path is not None
+    changed = [piece for piece in pieces if not manifest.is_current(piece, breakdown)]
+    updated = []
+    try:
+        for piece in changed:
+            print('Arranging', piece, file=sys.stderr)
+            try:
+                snapshot = manifest.snapshot(piece)
+            except OSError as e:
+                # e.g. the file was deleted after the folder was listed, so its entry is removed on the next run
+                print('Error: Could not read', piece, '-', repr(e), file=sys.stderr)
+                continue
+            try:
+                duet = BrassDuet(piece)
+                duet.arrange(printDifficulties=False)
+            except (Exception, SystemExit) as e:
+                print('Error: Could not arrange', piece, '-', repr(e), file=sys.stderr)
+                manifest.update(piece, snapshot, [], [] if breakdown else None, error=repr(e))
+            else:
+                manifest.update(piece, snapshot, arrangement_rows(duet), arrangement_breakdown_rows(duet) if breakdown else None)
+            updated.append(piece)
+    finally:
+        # Save the files arranged so far even if the run is interrupted
+        # The .csv files are written before the manifest, so if that is interrupted the files are just arranged again
+        if updated or removed or not data_path.exists():
+            data_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(data_path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(DATA_HEADER)
+                writer.writerows(manifest.rows(pieces))
+            print('Data saved to', data_path, file=sys.stderr)
+        if breakdown and (updated or removed or not breakdown_path.exists()):
+            save_breakdown(breakdown_path, manifest.rows(pieces, 'breakdown'))
+        if manifest.modified:
+            manifest.save()
+    return (changed, removed)
 
 def arrange_mode(args):
     duet = BrassDuet(Path(args.path))
-    duet.arrange()
+    duet.arrange(time_budget=args.time_budget)
+    if args.fingerings:
+        duet.print_fingerings()
+    if args.breakdown:
+        duet.get_arrangement().export_breakdown(OUT_DIR / (duet.in_path.stem + '_breakdown.csv'))
     if args.save:
         duet.save()
     else:
@@ -136,11 +287,59 @@ def arrange_mode(args):
         else:
             duet.show()
 
-def data_mode(args):
-    pieces = list(EXAMPLES_DIR.glob('*.mxl'))
+def search_mode(args):
+    path = Path(args.path)
+    if args.instruments:
+        unknown = [name for name in args.instruments if name not in INSTRUMENTS]
+        if unknown:
+            print('Error: Unknown instruments:', ', '.join(unknown), file=sys.stderr)
+            return
+        catalogue = {name: INSTRUMENTS[name] for name in args.instruments}
+    else:
+        catalogue = INSTRUMENTS
+    score = load.load_xml(path)
+    candidates = search_instruments(score, catalogue)
+    if not candidates:
+        print('Error: No combination of instruments can play this score in range', file=sys.stderr)
+        return
+
+    print('Instruments,Sharps,Overall')
+    for c in candidates[:args.top]:
+        # Instruments that play a part identically are listed together, e.g. cornet/trumpet
+        print(' + '.join('/'.join(group) for group in c.groups), c.sharps, c.total_difficulty, sep=',')
+
+    best = candidates[0]
+    duet = BrassDuet(path, instruments=tuple(catalogue[name] for name in best.names), score=score)
+    duet.arrange(printDifficulties=False, keys=[best.sharps])
+    if args.save:
+        duet.save()
+    else:
+        duet.show(transposable=args.transposable)
+
+def get_pieces(args):
+    directory = Path(args.directory)
+    pieces = list(directory.glob('*.mxl'))
     if args.tests:
-        pieces += list(TEST_DIR.glob('*.mxl'))
-    generate_data(pieces)
+        pieces += list((directory / 'test').glob('*.mxl'))
+    return pieces
+
+def data_mode(args):
+    breakdown_path = Path(args.breakdown) if args.breakdown else None
+    if args.watch:
+        try:
+            while True:
+                try:
+                    generate_data_incremental(get_pieces(args), Path(args.output), Path(args.manifest), breakdown_path)
+                except Exception as e:
+                    # e.g. a file was deleted while checking for changes, so just try again next time
+                    print('Error:', repr(e), file=sys.stderr)
+                time.sleep(args.interval)
+        except KeyboardInterrupt:
+            pass
+    elif args.incremental:
+        generate_data_incremental(get_pieces(args), Path(args.output), Path(args.manifest), breakdown_path)
+    else:
+        generate_data(get_pieces(args), breakdown_path)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -161,15 +360,109 @@ if __name__ == '__main__':
         dest='transposable',
         action="store_true",
         help="Show score with makeNotation=False to allow MuseScore to use transposing instruments correctly")
+    arrange_parser.add_argument(
+        '-f',
+        '--fingerings',
+        dest='fingerings',
+        action="store_true",
+        help="Print the chosen valve combination for each note")
+    arrange_parser.add_argument(
+        '-b',
+        '--time-budget',
+        dest='time_budget',
+        type=float,
+        help="Don't start a key that would likely take the arrangement over this many seconds and use the best arrangement so far (loading and saving the score aren't counted)")
+    arrange_parser.add_argument(
+        '-d',
+        '--breakdown',
+        dest='breakdown',
+        action="store_true",
+        help="Save the difficulty of each passage and measure to out/<filename>_breakdown.csv")
     arrange_parser.set_defaults(func=arrange_mode)
 
-    data_parser = subparsers.add_parser('generate-data', help="Generate difficulty metrics for all files in \"examples\" directory")
+    search_parser = subparsers.add_parser('search', help="Find the easiest pair of instruments, part assignment and key for a two-part score")
+    search_parser.add_argument('path', help="Path to .mxl file to be arranged")
+    search_parser.add_argument(
+        '-i',
+        '--instruments',
+        dest='instruments',
+        nargs='+',
+        help="Names of instruments to choose from (default: all of " + ', '.join(INSTRUMENTS) + ")")
+    search_parser.add_argument(
+        '-n',
+        '--top',
+        dest='top',
+        type=int,
+        default=10,
+        help="Number of easiest combinations to print")
+    search_parser.add_argument(
+        '-s',
+        '--save',
+        dest='save',
+        action="store_true",
+        help="Save easiest arrangement to output file")
+    search_parser.add_argument(
+        '-t',
+        '--transposable',
+        dest='transposable',
+        action="store_true",
+        help="Show score with makeNotation=False to allow MuseScore to use transposing instruments correctly")
+    search_parser.set_defaults(func=search_mode)
+
+    data_parser = subparsers.add_parser('generate-data', help="Generate difficulty metrics for all files in a directory")
+    data_parser.add_argument(
+        "directory",
+        nargs="?",
+        default=str(EXAMPLES_DIR),
+        help="Directory of .mxl files to arrange (default: \"examples\")"
+    )
     data_parser.add_argument(
         "-t",
         "--include-tests",
         dest="tests",
         action="store_true",
-        help="Include test cases files found in \"examples/test/\""
+        help="Include test cases files found in the \"test/\" subdirectory"
+    )
+    data_parser.add_argument(
+        "-i",
+        "--incremental",
+        dest="incremental",
+        action="store_true",
+        help="Only arrange new or changed files and update the .csv output file in place"
+    )
+    data_parser.add_argument(
+        "-w",
+        "--watch",
+        dest="watch",
+        action="store_true",
+        help="Keep watching for new, changed or deleted files and update the .csv output file (implies -i)"
+    )
+    data_parser.add_argument(
+        "--interval",
+        dest="interval",
+        type=float,
+        default=2.0,
+        help="Seconds between checks for changes in watch mode"
+    )
+    data_parser.add_argument(
+        "-o",
+        "--output",
+        dest="output",
+        default=str(DATA_PATH),
+        help="Path to .csv output file for incremental mode"
+    )
+    data_parser.add_argument(
+        "-m",
+        "--manifest",
+        dest="manifest",
+        default=str(MANIFEST_PATH),
+        help="Path to manifest file of content hashes for incremental mode"
+    )
+    data_parser.add_argument(
+        "-d",
+        "--breakdown",
+        dest="breakdown",
+        help="Also save the difficulty of each passage and measure of every arrangement to this .csv file (with -i or -w it is kept up to date along with the data file)"
     )
     data_parser.set_defaults(func=data_mode)
 
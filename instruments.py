@@ -43,6 +43,32 @@ class CustomBrassInstrument(BrassInstrument):
             84: 0    # C6
         }
 
+        # Alternative valve combinations that can be used instead of the standard fingering
+        self.alternate_fingerings = {
+            64: [3],  # E4
+            69: [3],  # A4
+            74: [13], # D5
+            75: [23], # E-5
+            76: [12], # E5
+            78: [23], # F#5
+            79: [13], # G5
+            81: [3]   # A5
+        }
+
+    # Returns all valve combinations for a written MIDI pitch, standard fingering first
+    def fingerings(self, midi):
+        return [self.fingering[midi]] + self.alternate_fingerings.get(midi, [])
+
+    # Instruments with the same signature give identical written parts for the same concert pitch part
+    def written_signature(self):
+        return (
+            self.transposeToWritten.directedName,
+            self.lowest_written().nameWithOctave,
+            self.highest_written().nameWithOctave,
+            tuple(self.fingering.items()),
+            tuple((midi, tuple(f)) for (midi, f) in self.alternate_fingerings.items())
+        )
+
     def lowest_written(self):
         return self.lowestNote.transpose(self.transposeToWritten)
 
@@ -55,6 +81,83 @@ class CustomBrassInstrument(BrassInstrument):
     def highest_concert(self):
         return self.highestNote
 
+# Catalogue of instruments available for arranging, by name
+INSTRUMENTS = {}
+
+# Class decorator to add an instrument to the catalogue under the given name
+def register_instrument(name):
+    def register(instrument):
+        INSTRUMENTS[name] = instrument
+        return instrument
+    return register
+
+@register_instrument('soprano-cornet')
+class SopranoCornet(CustomBrassInstrument):
+    def __init__(self):
+        super().__init__()
+
+        self.instrumentName = 'Soprano Cornet'
+        self.instrumentAbbreviation = 'Sop'
+        self.instrumentSound = 'brass.cornet.soprano'
+
+        # In concert pitch
+        self.lowestNote = pitch.Pitch('A3')
+        self.highestNote = pitch.Pitch('E-6')
+
+        # Written -> Concert
+        self.transposition = interval.Interval('m3')
+        self.transposeToConcert = self.transposition
+        # Concert -> Written
+        self.transposeToWritten = interval.Interval('m-3')
+
+@register_instrument('cornet')
+class Cornet(CustomBrassInstrument):
+    def __init__(self):
+        super().__init__()
+
+        self.instrumentName = 'Cornet'
+        self.instrumentAbbreviation = 'Cnt'
+        self.instrumentSound = 'brass.cornet'
+
+        # In concert pitch
+        self.lowestNote = pitch.Pitch('E3')
+        self.highestNote = pitch.Pitch('B-5')
+
+        # Written -> Concert
+        self.transposition = interval.Interval('M-2')
+        self.transposeToConcert = self.transposition
+        # Concert -> Written
+        self.transposeToWritten = interval.Interval('M2')
+
+@register_instrument('trumpet')
+class Trumpet(Cornet):
+    def __init__(self):
+        super().__init__()
+
+        self.instrumentName = 'Trumpet'
+        self.instrumentAbbreviation = 'Tpt'
+        self.instrumentSound = 'brass.trumpet'
+
+@register_instrument('flugelhorn')
+class Flugelhorn(CustomBrassInstrument):
+    def __init__(self):
+        super().__init__()
+
+        self.instrumentName = 'Flugelhorn'
+        self.instrumentAbbreviation = 'Flug'
+        self.instrumentSound = 'brass.flugelhorn'
+
+        # In concert pitch
+        self.lowestNote = pitch.Pitch('E3')
+        self.highestNote = pitch.Pitch('F5')
+
+        # Written -> Concert
+        self.transposition = interval.Interval('M-2')
+        self.transposeToConcert = self.transposition
+        # Concert -> Written
+        self.transposeToWritten = interval.Interval('M2')
+
+@register_instrument('tenor-horn')
 class TenorHorn(CustomBrassInstrument):
     def __init__(self):
         super().__init__()
@@ -73,6 +176,7 @@ class TenorHorn(CustomBrassInstrument):
         # Concert -> Written
         self.transposeToWritten = interval.Interval('M6')
 
+@register_instrument('baritone')
 class BaritoneHorn(CustomBrassInstrument):
     def __init__(self):
         super().__init__()
@@ -90,3 +194,61 @@ class BaritoneHorn(CustomBrassInstrument):
         self.transposeToConcert = self.transposition
         # Concert -> Written
         self.transposeToWritten = interval.Interval('M9')
+
+@register_instrument('euphonium')
+class Euphonium(BaritoneHorn):
+    def __init__(self):
+        super().__init__()
+
+        self.instrumentName = 'Euphonium'
+        self.instrumentAbbreviation = 'Euph'
+        self.instrumentSound = 'brass.euphonium'
+
+# Tenor trombone reading treble clef in B-flat, as in brass bands
+# Slide positions are scored as the equivalent valve combinations
+@register_instrument('trombone')
+class Trombone(BaritoneHorn):
+    def __init__(self):
+        super().__init__()
+
+        self.instrumentName = 'Trombone'
+        self.instrumentAbbreviation = 'Tbn'
+        self.instrumentSound = 'brass.trombone.tenor'
+
+@register_instrument('eb-bass')
+class EbBass(CustomBrassInstrument):
+    def __init__(self):
+        super().__init__()
+
+        self.instrumentName = 'E-flat Bass'
+        self.instrumentAbbreviation = 'Eb Bass'
+        self.instrumentSound = 'brass.tuba'
+
+        # In concert pitch
+        self.lowestNote = pitch.Pitch('A1')
+        self.highestNote = pitch.Pitch('E-4')
+
+        # Written -> Concert
+        self.transposition = interval.Interval('M-13')
+        self.transposeToConcert = self.transposition
+        # Concert -> Written
+        self.transposeToWritten = interval.Interval('M13')
+
+@register_instrument('bb-bass')
+class BbBass(CustomBrassInstrument):
+    def __init__(self):
+        super().__init__()
+
+        self.instrumentName = 'B-flat Bass'
+        self.instrumentAbbreviation = 'Bb Bass'
+        self.instrumentSound = 'brass.tuba'
+
+        # In concert pitch
+        self.lowestNote = pitch.Pitch('E1')
+        self.highestNote = pitch.Pitch('B-3')
+
+        # Written -> Concert
+        self.transposition = interval.Interval('M-16')
+        self.transposeToConcert = self.transposition
+        # Concert -> Written
+        self.transposeToWritten = interval.Interval('M16')
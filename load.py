@@ -31,16 +31,16 @@ def convert_clef(part):
     part.remove(clefs, recurse=True)
     part.measure(0,indicesNotNumbers=True).insert(0, clef.TrebleClef())
 
-# Converts instruments to Tenor Horn and Baritone
-def convert_instruments(score):
+# Converts instruments to the given pair of instrument classes (Tenor Horn and Baritone by default)
+def convert_instruments(score, instruments=(TenorHorn, BaritoneHorn)):
     score.atSoundingPitch = True
-    part_1 = stream.base.Part([TenorHorn()])
+    part_1 = stream.base.Part([instruments[0]()])
     part_1.append(list(score.parts[0].getElementsNotOfClass('Instrument')))
     convert_clef(part_1)
     convert_voices(part_1)
     convert_chords(part_1, keepTop=True)
 
-    part_2 = stream.base.Part([BaritoneHorn()])
+    part_2 = stream.base.Part([instruments[1]()])
     part_2.append(list(score.parts[1].getElementsNotOfClass('Instrument')))
     convert_clef(part_2)
     convert_voices(part_2)
@@ -49,16 +49,22 @@ def convert_instruments(score):
     score.removeByClass(['Part', 'StaffGroup'])
     score.append([part_1, part_2])
 
+# Replaces the instrument of each part of an already converted score with the given instrument classes
+def set_instruments(score, instruments):
+    for (part, instrument) in zip(score.parts, instruments):
+        part.removeByClass('Instrument')
+        part.insert(0, instrument())
+
 def parse_xml(path, isCorpus=False):
     if isCorpus:
         return corpus.parse(path)
     else:
         return converter.parse(path)
 
-def load_xml(path, isCorpus=False):
+def load_xml(path, isCorpus=False, instruments=(TenorHorn, BaritoneHorn)):
     score = parse_xml(path, isCorpus)
     if len(score.parts) != 2:
         print('Error: Score doesn\'t have two parts',file=sys.stderr)
         sys.exit()
-    convert_instruments(score)
+    convert_instruments(score, instruments)
     return score
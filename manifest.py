@@ -0,0 +1,101 @@
+import hashlib
+import json
+from pathlib import Path
+
+
+# Returns the SHA-256 hex digest of a file's contents
+def file_hash(path, chunk_size=1 << 16):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+# Keeps track of the content hash of each arranged file and the data (and breakdown) rows generated from it,
+# so that only new or changed files need to be arranged again
+# The version identifies the code and format used to generate the rows. If a saved manifest has a
+# different version all of its entries are discarded, so every file is arranged again
+class Manifest:
+    def __init__(self, path: Path, version=None):
+        self.path = path
+        self.version = version
+        self.entries = {}
+        self.modified = False
+        if self.path.exists():
+            with open(self.path) as f:
+                saved = json.load(f)
+            if saved.get('version') == version:
+                self.entries = saved['entries']
+            else:
+                self.modified = True
+
+    @staticmethod
+    def key(piece):
+        return Path(piece).as_posix()
+
+    # Tests if the stored rows for a file are still valid
+    # If breakdown is True, the entry must also have breakdown rows
+    # The file is only hashed if its size or modification time have changed since the last run
+    def is_current(self, piece, breakdown=False):
+        entry = self.entries.get(self.key(piece))
+        if entry is None or (breakdown and 'breakdown' not in entry):
+            return False
+        stat = Path(piece).stat()
+        if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            return True
+        if entry['size'] != stat.st_size or entry['hash'] != file_hash(piece):
+            return False
+        # Contents unchanged (e.g. file was touched), so just refresh the stat info
+        entry['mtime'] = stat.st_mtime_ns
+        self.modified = True
+        return True
+
+    # Returns the stat info and content hash of a file
+    # Take this before arranging the file, so that saving the file again while it is being
+    # arranged makes the stored entry out of date instead of hiding the change
+    @staticmethod
+    def snapshot(piece):
+        stat = Path(piece).stat()
+        return {
+            'hash': file_hash(piece),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns
+        }
+
+    # Stores the rows generated from a file along with the snapshot taken before generating them
+    # Breakdown rows are only stored if they are given, since they are much larger than the data rows
+    # If the file couldn't be arranged, the error is stored (with no rows) so it is only tried again once it changes
+    def update(self, piece, snapshot, rows, breakdown_rows=None, error=None):
+        entry = dict(snapshot, rows=rows)
+        if breakdown_rows is not None:
+            entry['breakdown'] = breakdown_rows
+        if error is not None:
+            entry['error'] = error
+        self.entries[self.key(piece)] = entry
+        self.modified = True
+
+    # Removes entries for files that are no longer present
+    # Returns the list of removed keys
+    def prune(self, pieces):
+        keep = {self.key(piece) for piece in pieces}
+        removed = [k for k in self.entries if k not in keep]
+        for k in removed:
+            del self.entries[k]
+        if removed:
+            self.modified = True
+        return removed
+
+    # Returns the stored data rows (or breakdown rows if field is 'breakdown') in the order of the given files
+    def rows(self, pieces, field='rows'):
+        rows = []
+        for piece in pieces:
+            entry = self.entries.get(self.key(piece))
+            if entry is not None:
+                rows += entry[field]
+        return rows
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump({'version': self.version, 'entries': self.entries}, f, indent=1)
+        self.modified = False
@@ -0,0 +1,149 @@
+from itertools import product
+
+from difficulty import *
+from instruments import INSTRUMENTS
+from passage import get_segments
+from util import *
+
+
+# Difficulty of one combination of instruments (for the first and second parts) and concert pitch key
+# groups holds the names of every instrument in the catalogue that plays each part identically
+# in this key, and names holds the first of each
+class Candidate:
+    def __init__(self, groups, sharps, difficulties):
+        self.groups = groups
+        self.names = tuple(group[0] for group in groups)
+        self.sharps = sharps
+        self.difficulties = difficulties
+        self.total_difficulty = difficulties[-1]
+
+# Transposes a list of pitches by an interval, transposing each differently spelled pitch only once
+# Pitches spelled the same share the same transposed Pitch object, so they mustn't be changed in place
+def transpose_pitches(pitches, interval):
+    transposed = {}
+    result = []
+    for p in pitches:
+        name = p.nameWithOctave
+        if name not in transposed:
+            transposed[name] = p.transpose(interval)
+        result.append(transposed[name])
+    return result
+
+# The notes of one part of a concert pitch score, in the form needed to score it for any key and instrument
+# Passages, ties, durations, dynamics and slurs don't depend on pitch, so they are only worked out once
+# and each key and instrument only needs to transpose the list of pitches
+class PartNotes:
+    def __init__(self, part, analysis_part):
+        flat_part = part.flatten()
+        notes = list(flat_part.getElementsByClass('Note'))
+        self.pitches = [n.pitch for n in notes]
+        position = {id(n): i for (i, n) in enumerate(notes)}
+        # Index of the first note at each offset
+        note_at_offset = {}
+        for (i, n) in enumerate(notes):
+            note_at_offset.setdefault(flat_part.elementOffset(n), i)
+        # Indices of the notes in each passage (see get_segments())
+        self.passages = [[position[id(n)] for n in passage.get_notes()] for passage in get_segments(part)]
+        # (ElementInfo, index of its note's pitch or None for rests) for each note and rest with ties stripped
+        self.elements = []
+        flat_analysis = analysis_part.flatten()
+        for element in flat_analysis.notesAndRests:
+            info = ElementInfo(element)
+            # Read the values that depend on the element's context while it is being iterated
+            info.seconds
+            if info.is_note:
+                info.dynamic
+                info.phrase_end
+            index = note_at_offset[flat_analysis.elementOffset(element)] if info.is_note else None
+            self.elements.append((info, index))
+
+    # Transposes the part to written pitch for an instrument and moves each passage into its easiest register
+    # (the same as toWrittenPitch() followed by optimise_part_register())
+    # Returns the list of written pitches, or None if a passage can't be played within the instrument's range
+    def written_pitches(self, concert_pitches, instrument, lowest, highest):
+        pitches = transpose_pitches(concert_pitches, instrument.transposeToWritten)
+        for passage in self.passages:
+            (_, transposed, out_of_range_first, out_of_range_second) = passage_octave_transposition(
+                [pitches[i] for i in passage], lowest, highest
+            )
+            if out_of_range_first and out_of_range_second:
+                return None
+            for (i, p) in zip(passage, transposed):
+                pitches[i] = p
+        return pitches
+
+    # Runs every registered metric over the part played at the given written pitches
+    def metrics(self, pitches, instrument, lowest, highest):
+        events = (
+            NoteEvent(info, i, pitches[index] if info.is_note else None, instrument, lowest, highest)
+            for (i, (info, index)) in enumerate(self.elements)
+        )
+        metrics = {}
+        for reducer in run_reducers(events):
+            metrics.update(reducer.result())
+        return metrics
+
+# Finds the easiest combination of instrument pair, part assignment and key for a loaded score
+# Each instrument in the catalogue is only scored once per key (playing both parts), since the
+# difficulty of a part doesn't depend on the other instrument, and the pairs are then scored from
+# the stored part metrics. Instruments with the same written signature are only scored once, and
+# instruments that play a part identically in a key are grouped into a single Candidate, so they don't
+# fill the list with tied entries.
+# The score is only analysed once: each key and instrument transposes the pitches of its notes
+# rather than the whole score (see PartNotes).
+# Returns a list of Candidates sorted from easiest to hardest
+def search_instruments(score, catalogue=INSTRUMENTS, keys=KEYS, part_weights=[0.5,0.5]):
+    original_key = getKey(score)
+    # Instrument signature -> names of the instruments with that signature, in catalogue order
+    signatures = {}
+    for name in catalogue:
+        signatures.setdefault(catalogue[name]().written_signature(), []).append(name)
+
+    analysis_score = score.stripTies()
+    parts = [PartNotes(score.parts[i], analysis_score.parts[i]) for i in range(len(score.parts))]
+
+    # (instrument signature, part index, sharps) -> part metrics, or None if out of range
+    part_results = {}
+    for sharps in keys:
+        interval = key_interval(score, sharps)
+        for i in range(len(parts)):
+            concert_pitches = transpose_pitches(parts[i].pitches, interval)
+            for (signature, group) in signatures.items():
+                instrument = catalogue[group[0]]()
+                lowest = instrument.lowest_written()
+                highest = instrument.highest_written()
+                pitches = parts[i].written_pitches(concert_pitches, instrument, lowest, highest)
+                if pitches is None:
+                    part_results[(signature, i, sharps)] = None
+                else:
+                    part_results[(signature, i, sharps)] = parts[i].metrics(pitches, instrument, lowest, highest)
+
+    candidates = []
+    for sharps in keys:
+        # For each part, instruments that play it identically in this key (the same part metrics and
+        # the same number of sharps or flats written) are grouped as (part metrics, instrument, names)
+        part_groups = []
+        for i in range(len(part_weights)):
+            groups = {}
+            for (signature, group) in signatures.items():
+                metrics = part_results[(signature, i, sharps)]
+                if metrics is None:
+                    continue
+                instrument = catalogue[group[0]]()
+                outcome = (tuple(metrics.items()), avg_sharps_per_instrument(sharps, [instrument]))
+                groups.setdefault(outcome, (metrics, instrument, []))[2].extend(group)
+            part_groups.append(list(groups.values()))
+        for combination in product(*part_groups):
+            metrics = {}
+            for i in range(len(combination)):
+                for name, value in combination[i][0].items():
+                    metrics[name] = metrics.get(name, 0) + part_weights[i] * value
+            difficulties = normalise_difficulties(tuple(metrics[name] for name in DIFFICULTY_NAMES))
+            difficulties = combine_difficulties(
+                difficulties,
+                avg_sharps_per_instrument(sharps, [instrument for (_, instrument, _) in combination]),
+                key_distance(original_key.sharps, sharps)
+            )
+            candidates.append(Candidate(tuple(names for (_, _, names) in combination), sharps, difficulties))
+
+    return sorted(candidates, key=lambda c: c.total_difficulty)
@@ -2,6 +2,8 @@ from music21 import interval, key
 
 from instruments import *
 
+# Concert pitch key signatures (in number of sharps) to try for each arrangement
+KEYS = range(-5, 2)
 
 # Trick to display output with transposing instruments working correctly
 def show(score, format=None):
@@ -21,18 +23,24 @@ def getKey(score):
 def key_distance(original_key, new_key):
     return min(abs(original_key - new_key), 12 - abs(original_key - new_key))
 
-# Transpose a score to the key with the given number of sharps, preserving key mode
-def transpose_to_key_sig(score, sharps):
+# Interval that transposes a score to the key with the given number of sharps, preserving key mode
+def key_interval(score, sharps):
     original_key = getKey(score)
     ks = key.KeySignature(sharps)
     new_key = ks.asKey(original_key.mode)
-    i = interval.Interval(original_key.tonic, new_key.tonic)
-    return score.transpose(i)
+    return interval.Interval(original_key.tonic, new_key.tonic)
+
+# Transpose a score to the key with the given number of sharps, preserving key mode
+def transpose_to_key_sig(score, sharps):
+    return score.transpose(key_interval(score, sharps))
 
 # Returns a dictionary of number of sharps written for each instrument for a given concert pitch key
-def get_sharps_per_instrument(sharps):
+# Uses Tenor Horn and Baritone if no instruments are given
+def get_sharps_per_instrument(sharps, instruments=None):
+    if instruments is None:
+        instruments = [TenorHorn(), BaritoneHorn()]
     ks = key.KeySignature(sharps)
     sharps_per_instrument = {}
-    for instr in [TenorHorn(), BaritoneHorn()]:
+    for instr in instruments:
         sharps_per_instrument[instr] = ks.transpose(instr.transposeToWritten).sharps
     return sharps_per_instrument